@@ -30,16 +30,16 @@ TOOL_DEPENDENCIES = {
 }
 
 
-def install_ion_hash_java(log):
-    log_call(log, ('mvn', 'install'))
+def install_ion_hash_java(log, cwd):
+    log_call(log, ('mvn', 'install'), cwd=cwd)
 
 
-def install_ion_hash_js(log):
-    log_call(log, ('npm', 'install'))
-    log_call(log, 'grunt')
+def install_ion_hash_js(log, cwd):
+    log_call(log, ('npm', 'install'), cwd=cwd)
+    log_call(log, 'grunt', cwd=cwd)
 
 
-def install_ion_hash_python(log):
+def install_ion_hash_python(log, cwd):
     pass
 
 
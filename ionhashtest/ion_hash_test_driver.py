@@ -15,7 +15,7 @@
 """Cross-implementation Ion Hash test driver.
 
 Usage:
-    ion_hash_test_driver.py [--git <path>] [--output-dir <dir>] [--results-file <file>] [<test_file>]...
+    ion_hash_test_driver.py [--git <path>] [--output-dir <dir>] [--results-file <file>] [--text-results] [<test_file>]...
     ion_hash_test_driver.py (--list)
     ion_hash_test_driver.py (-h | --help)
 
@@ -32,18 +32,23 @@ Options:
                                         `ion-hash-test-driver-results.ion` under the directory specified by the
                                         `--output-dir` option.
 
+    -t, --text-results                  Write the results file as pretty-printed text Ion instead of binary Ion.
+                                        Binary Ion is smaller and faster to write, but text is easier to inspect.
+
 
 """
 
 # Please note that there is significant duplication of logic between this project
 # and https://github.com/amzn/ion-test-driver
 
-from collections import defaultdict
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import os
+import re
 import sys
 import shutil
-from subprocess import check_call, check_output, Popen, PIPE
-import six
+from subprocess import check_call, check_output, Popen, DEVNULL
 from amazon.ion import simpleion
 from amazon.ion.symbols import SymbolToken
 from docopt import docopt
@@ -51,12 +56,27 @@ from docopt import docopt
 from ionhashtest.config import TOOL_DEPENDENCIES, ION_BUILDS, ION_IMPLEMENTATIONS, ION_HASH_TEST_SOURCE, \
     RESULTS_FILE_DEFAULT
 from ionhashtest.util import COMMAND_SHELL, log_call
+from ionhashtest import test_data
 from ionhashtest.test_data import generate_tests
 
 
 ION_SUFFIX_TEXT = '.ion'
 ION_SUFFIX_BINARY = '.10n'
 
+# Matches a full 40-character commit SHA, as read from a repository's refs.
+_COMMIT_SHA_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+
+# Matches a revision that names a commit, possibly abbreviated. Branch and tag revisions can be cloned shallowly;
+# arbitrary commits cannot. An all-hex branch name would be misclassified, but only costs a full clone.
+_COMMIT_REVISION_PATTERN = re.compile(r'^[0-9a-f]{7,40}$')
+
+# Result symbols are interned once rather than constructed per test value.
+_RESULT_TOKENS = {
+    'consistent': SymbolToken('consistent', None, None),
+    'inconsistent': SymbolToken('inconsistent', None, None),
+    'no_comparison': SymbolToken('no_comparison', None, None),
+}
+
 
 def check_tool_dependencies(args):
     """
@@ -68,20 +88,62 @@ def check_tool_dependencies(args):
         path = args['--' + name]
         if path:
             TOOL_DEPENDENCIES[name] = path
-    for name, path in six.iteritems(TOOL_DEPENDENCIES):
+
+    def probe(tool):
+        name, path = tool
         try:
             # NOTE: if a tool dependency is added that doesn't have a `--help` command, the logic should be generalized
             # to call a tool-specific command to test the existence of the executable. This should be a command that
             # always returns zero.
-            no_output = open(os.devnull, 'w')
-            check_call([path, '--help'], stdout=no_output, shell=COMMAND_SHELL)
+            check_call([path, '--help'], stdout=DEVNULL, shell=COMMAND_SHELL)
         except:
-            raise ValueError(name + " not found. Try specifying its location using --" + name + ".")
-        finally:
-            no_output.close()
+            return name
+        return None
+
+    # The probes are independent and bound on process startup, so run them concurrently.
+    with ThreadPoolExecutor(max_workers=len(TOOL_DEPENDENCIES)) as executor:
+        missing = [name for name in executor.map(probe, TOOL_DEPENDENCIES.items()) if name is not None]
+    if missing:
+        raise ValueError(missing[0] + " not found. Try specifying its location using --" + missing[0] + ".")
+
+
+def git_head_commit(repo_dir):
+    """
+    Returns the short (7-character) commit SHA of the given repository's HEAD. The commit is read directly from
+    the repository's metadata, avoiding a git subprocess; a `git rev-parse` fallback covers layouts this does not
+    handle (e.g. worktrees and submodules, where `.git` is a file rather than a directory).
+    """
+    try:
+        with open(os.path.join(repo_dir, '.git', 'HEAD')) as head_file:
+            head = head_file.read().strip()
+        if head.startswith('ref: '):
+            ref = head[len('ref: '):]
+            ref_path = os.path.join(repo_dir, '.git', *ref.split('/'))
+            if os.path.isfile(ref_path):
+                with open(ref_path) as ref_file:
+                    head = ref_file.read().strip()
+            else:
+                head = None
+                packed_refs_path = os.path.join(repo_dir, '.git', 'packed-refs')
+                if os.path.isfile(packed_refs_path):
+                    with open(packed_refs_path) as packed_refs_file:
+                        for line in packed_refs_file:
+                            fields = line.split()
+                            if len(fields) == 2 and fields[1] == ref:
+                                head = fields[0]
+                                break
+        if head is not None and _COMMIT_SHA_PATTERN.match(head):
+            return head[:7]
+    except (IOError, OSError):
+        pass
+    return check_output((TOOL_DEPENDENCIES['git'], 'rev-parse', '--short', 'HEAD'), cwd=repo_dir).strip().decode()
 
 
 class IonResource:
+    # Caches the (identifier, build directory) resolved for a (location, revision) pair so that repeated
+    # installations of the same source within a run reuse the first clone.
+    _resolved_revisions = {}
+
     def __init__(self, output_root, name, location, revision):
         """
         Provides the installation logic for a resource required to run the tests.
@@ -110,42 +172,65 @@ class IonResource:
             raise ValueError('Implementation %s must be installed before receiving an identifier.' % self.name)
         return self.__identifier
 
+    def __set_build_log(self):
+        logs_dir = os.path.abspath(os.path.join(self.__output_root, 'build', 'logs'))
+        # The logs directory is shared by all resources, and installations run concurrently; exist_ok tolerates
+        # another thread creating it between the check and the makedirs call.
+        os.makedirs(logs_dir, exist_ok=True)
+        self.__build_log = os.path.abspath(os.path.join(logs_dir, self.__identifier + '.txt'))
+
     def __git_clone_revision(self):
+        # A clone of this (location, revision) pair may already exist, either from earlier in this run or--when the
+        # revision pins a specific commit--from a previous run. Reusing it avoids the clone entirely.
+        cached = IonResource._resolved_revisions.get((self.__location, self.__revision))
+        if cached is None and self.__revision is not None and _COMMIT_REVISION_PATTERN.match(self.__revision):
+            candidate_dir = os.path.abspath(
+                os.path.join(self.__output_root, 'build', self.name + '_' + self.__revision[:7]))
+            if os.path.isdir(os.path.join(candidate_dir, '.git')):
+                cached = (self.name + '_' + self.__revision[:7], candidate_dir)
+        if cached is not None:
+            self.__identifier, self._build_dir = cached
+            self.__set_build_log()
+            print("%s already present. Using existing source." % self._build_dir)
+            return
         # The commit is not yet known; clone into a temporary location to determine the commit and decide whether the
         # code for that revision is already present. If it is, use the existing code, as it may have already been built.
-        tmp_dir_root = os.path.abspath((os.path.join(self.__output_root, 'build', 'tmp')))
+        # Each resource gets its own temporary root so that installations may proceed concurrently.
+        tmp_dir_root = os.path.abspath((os.path.join(self.__output_root, 'build', 'tmp', self.name)))
+        git = TOOL_DEPENDENCIES['git']
         try:
-            tmp_dir = os.path.abspath(os.path.join(tmp_dir_root, self.name))
+            tmp_dir = os.path.abspath(os.path.join(tmp_dir_root, 'src'))
             if not os.path.isdir(tmp_dir_root):
                 os.makedirs(tmp_dir_root)
             tmp_log = os.path.abspath(os.path.join(tmp_dir_root, 'tmp_log.txt'))
-            log_call(tmp_log, (TOOL_DEPENDENCIES['git'], 'clone', '--recurse-submodules', self.__location,
-                     tmp_dir))
-            os.chdir(tmp_dir)
-            if self.__revision is not None:
-                log_call(tmp_log, (TOOL_DEPENDENCIES['git'], 'checkout', self.__revision))
-                log_call(tmp_log, (TOOL_DEPENDENCIES['git'], 'submodule', 'update', '--init'))
-            commit = check_output((TOOL_DEPENDENCIES['git'], 'rev-parse', '--short', 'HEAD')).strip()
-            self.__identifier = self.name + '_' + commit.decode()
+            if self.__revision is None or _COMMIT_REVISION_PATTERN.match(self.__revision):
+                # Shallow clones cannot check out arbitrary commits; fall back to a full-history clone.
+                log_call(tmp_log, (git, 'clone', '--recurse-submodules', '--jobs', '8', self.__location, tmp_dir))
+                if self.__revision is not None:
+                    # checkout --recurse-submodules updates the submodules too, saving a subprocess.
+                    log_call(tmp_log, (git, '-c', 'advice.detachedHead=false', 'checkout', '--recurse-submodules',
+                             self.__revision), cwd=tmp_dir)
+            else:
+                # The revision is a branch or tag tip; only its HEAD is needed, so avoid transferring history.
+                log_call(tmp_log, (git, 'clone', '--recurse-submodules', '--shallow-submodules', '--depth', '1',
+                         '--branch', self.__revision, '--jobs', '8', self.__location, tmp_dir))
+            self.__identifier = self.name + '_' + git_head_commit(tmp_dir)
             self._build_dir = os.path.abspath(os.path.join(self.__output_root, 'build', self.__identifier))
-            logs_dir = os.path.abspath(os.path.join(self.__output_root, 'build', 'logs'))
-            if not os.path.isdir(logs_dir):
-                os.makedirs(logs_dir)
-            self.__build_log = os.path.abspath(os.path.join(logs_dir, self.__identifier + '.txt'))
+            self.__set_build_log()
             if not os.path.exists(self._build_dir):
                 shutil.move(tmp_log, self.__build_log)  # This build is being used, overwrite an existing log (if any).
                 shutil.move(tmp_dir, self._build_dir)
             else:
                 print("%s already present. Using existing source." % self._build_dir)
+            IonResource._resolved_revisions[(self.__location, self.__revision)] = (self.__identifier, self._build_dir)
         finally:
-            shutil.rmtree(tmp_dir_root)
+            if os.path.isdir(tmp_dir_root):
+                shutil.rmtree(tmp_dir_root)
 
     def install(self):
         print('Installing %s revision %s.' % (self.name, self.__revision))
         self.__git_clone_revision()
-        os.chdir(self._build_dir)
-        self._build.install(self.__build_log)
-        os.chdir(self.__output_root)
+        self._build.install(self.__build_log, self._build_dir)
         print('Done installing %s.' % self.identifier)
         return self._build_dir
 
@@ -176,55 +261,64 @@ class IonHashImplementation(IonResource):
             raise ValueError('Executable for %s does not exist.' % self.name)
 
         for test_file in test_files:
-            with open(os.path.join("build", test_file + "." + self.name + ".hashes"), "w") as outfile:
-                _, stderr = Popen([self._executable, algorithm, test_file],
-                                  stdin=PIPE, stdout=outfile, stderr=PIPE).communicate()
-                if len(stderr) > 0:
-                    print(stderr)
-
-
-def generate_results(impls, test_files, results_file):
+            # A large binary buffer keeps digest lines from being flushed to disk one line at a time. Sending
+            # stderr to a file instead of a pipe avoids the extra drain thread communicate() would need; stderr
+            # is almost always empty, so it is only read back when the file ends up non-empty.
+            errors_file = test_file + "." + self.name + ".errors"
+            with open(test_file + "." + self.name + ".hashes", "wb", buffering=1 << 20) as outfile, \
+                    open(errors_file, "wb", buffering=1 << 20) as errfile:
+                Popen([self._executable, algorithm, test_file],
+                      stdin=DEVNULL, stdout=outfile, stderr=errfile, bufsize=-1).wait()
+            if os.path.getsize(errors_file) > 0:
+                # The implementation may emit arbitrary bytes on stderr; don't let an undecodable byte crash the run.
+                with open(errors_file, errors='replace') as errfile:
+                    print(errfile.read())
+
+
+def generate_results(impls, test_files, results_file, binary=True):
     """
-    Compares hashes produced by the implementations and writes test results to `results_file`.
-    Results are structured as follows:
+    Compares hashes produced by the implementations and streams test results to `results_file`.
+    Each test file's results are written as soon as they are computed, so only one file's comparisons
+    are held in memory at a time. The results are a stream of top-level structs, one per test file,
+    followed by a trailing summary struct:
     {
-      files: {
-        'ion_hash_tests.ion': {
-          tests: [
-            {
-              digest: "0f 50 c5 e5 e8 77 b4 45 1a a9 fe 77 c3 76 cd e4",
-              result: consistent,
-              value: "null"
-            },
-            ...
-          ],
-          file_summary: {
-            digest_consistent: 10,
-            test_count: 10,
-          },
+      file: "ion_hash_tests.ion",
+      tests: [
+        {
+          digest: "0f 50 c5 e5 e8 77 b4 45 1a a9 fe 77 c3 76 cd e4",
+          result: consistent,
+          value: "null"
         },
-        'ion_hash_tests.10n': {
-          tests: [
-            {
-              // when a value is hashed inconsistently, a nested 'digests' struct
-              // presents the hash calculated by each implementation:
-              digests: {
-                'ion-hash-java': "0f 50 c5 e5 e8 77 b4 45 1a a9 fe 77 c3 76 cd e4",
-                'ion-hash-js': "[unable to digest]",
-                'ion-hash-python': "0f 50 c5 e5 e8 77 b4 45 1a a9 fe 77 c3 76 cd e4",
-              },
-              result: inconsistent,
-              value: "null"
-            },
-            ...
-          ],
-          file_summary: {
-            digest_inconsistent: 2,
-            digest_no_comparison: 3,
-            test_count: 5,
+        ...
+      ],
+      file_summary: {
+        digest_consistent: 10,
+        test_count: 10,
+      },
+    }
+    {
+      file: "ion_hash_tests.10n",
+      tests: [
+        {
+          // when a value is hashed inconsistently, a nested 'digests' struct
+          // presents the hash calculated by each implementation:
+          digests: {
+            'ion-hash-java': "0f 50 c5 e5 e8 77 b4 45 1a a9 fe 77 c3 76 cd e4",
+            'ion-hash-js': "[unable to digest]",
+            'ion-hash-python': "0f 50 c5 e5 e8 77 b4 45 1a a9 fe 77 c3 76 cd e4",
           },
+          result: inconsistent,
+          value: "null"
         },
+        ...
+      ],
+      file_summary: {
+        digest_inconsistent: 2,
+        digest_no_comparison: 3,
+        test_count: 5,
       },
+    }
+    {
       summary: {
         digest_consistent: 10,
         digest_inconsistent: 2,
@@ -235,92 +329,89 @@ def generate_results(impls, test_files, results_file):
     :param impls: List of implementations that were tested.
     :param test_files: List of files that were hashed by each implementation.
     :param results_file: Filename to write the results to.
+    :param binary: If True, writes binary Ion; otherwise writes pretty-printed text Ion.
     """
-    counters = defaultdict(int)
-
-    files = dict()
-    for test_file in test_files:
-        is_binary = test_file.endswith(".10n")
-        with open(test_file, 'rb' if is_binary else 'r') as f:
-            content = f.read()
-        tests = simpleion.loads(content, single_value=False)
-
-        hash_files = {}
-        for impl in impls:
-            hash_files[impl.name] = open(test_file + "." + impl.name + ".hashes")
-
-        digest_comparisons = []
-        file_counters = defaultdict(int)
-        for test in tests:
-            result = compare_digests(test, hash_files, digest_comparisons)
-            file_counters[result] += 1
-            counters[result] += 1
-
-        file_summary = dict()
-        for result, count in file_counters.items():
-            file_summary['digest_' + result] = count
-        file_summary['test_count'] = sum([cnt for cnt in file_counters.values()])
-
-        files[test_file] = dict()
-        files[test_file]['tests'] = digest_comparisons
-        files[test_file]['file_summary'] = file_summary
-
-        for hash_file in hash_files.values():
-            hash_file.close()
-
-    summary = dict()
-    for result, count in counters.items():
-        summary['digest_' + result] = count
-    summary['test_count'] = sum([cnt for cnt in counters.values()])
-
-    results = dict()
-    results['files'] = files
-    results['summary'] = summary
-
-    with open(results_file, 'w') as f:
-        f.write(simpleion.dumps(results, binary=False, indent='  '))
+    counters = Counter()
+
+    def write_result(value, fp):
+        if binary:
+            simpleion.dump(value, fp, binary=True)
+        else:
+            fp.write(simpleion.dumps(value, binary=False, indent='  '))
+            fp.write('\n')
+
+    with open(results_file, 'wb' if binary else 'w', buffering=1 << 20) as results_fp:
+        for test_file in test_files:
+            is_binary = test_file.endswith(".10n")
+            with open(test_file, 'rb' if is_binary else 'r') as f:
+                content = f.read()
+            tests = simpleion.loads(content, single_value=False)
+
+            # Slurping each hashes file once and indexing into the lines avoids a Python-level readline call per
+            # implementation per test value. The lines stay as bytes through the comparison--the digests are
+            # ASCII either way--and are only decoded when emitted into the results.
+            hash_lines = {}
+            for impl in impls:
+                with open(test_file + "." + impl.name + ".hashes", 'rb') as hash_file:
+                    hash_lines[impl.name] = hash_file.read().splitlines()
+
+            digest_comparisons = []
+            for index, test in enumerate(tests):
+                compare_digests(test, hash_lines, index, digest_comparisons)
+
+            # Counting results in a single pass over the comparisons keeps the per-value loop free of bookkeeping.
+            file_counters = Counter(comparison['result'].text for comparison in digest_comparisons)
+            counters.update(file_counters)
+
+            file_summary = dict()
+            for result, count in file_counters.items():
+                file_summary['digest_' + result] = count
+            file_summary['test_count'] = sum(file_counters.values())
+
+            # Stream this file's results out immediately so the comparisons can be released before the next file.
+            write_result({'file': test_file, 'tests': digest_comparisons, 'file_summary': file_summary}, results_fp)
+
+        summary = dict()
+        for result, count in counters.items():
+            summary['digest_' + result] = count
+        summary['test_count'] = sum(counters.values())
+
+        write_result({'summary': summary}, results_fp)
     print("Results written to %s" % results_file)
 
 
-def compare_digests(value, hash_files, digest_comparisons):
+def compare_digests(value, hash_lines, index, digest_comparisons):
     """
-    For the given test value, reads the hash computed by each impl and determines whether
+    For the given test value, looks up the hash computed by each impl and determines whether
     the implementations are consistent or inconsistent.
     :param value: the Ion value to compare hashes of
-    :param hash_files: dict of implementation name to an open file object of hashes produced by that implementation.
-    :param digest_comparisons: a dict summarizing the result for `value`
-    :return: 'consistent', 'inconsistent', or 'no_comparison'
+    :param hash_lines: dict of implementation name to the list of digest lines produced by that implementation.
+    :param index: the position of `value`'s digest within each implementation's lines.
+    :param digest_comparisons: list to which a dict summarizing the result for `value` is appended.
     """
-    digests = {}
-    for impl_name, hash_file in hash_files.items():
-        digest = hash_file.readline().rstrip()
-        if digest.startswith("[unable to digest"):
-            digests[impl_name] = "[unable to digest]"
-        else:
-            digests[impl_name] = digest
-
-    digest_set = set(digests.values())
+    digests = []
+    for lines in hash_lines.values():
+        digest = lines[index].rstrip() if index < len(lines) else b''
+        if digest.startswith(b"[unable to digest"):
+            digest = b"[unable to digest]"
+        digests.append(digest)
 
     digest_comparison = {}
-    if len(digest_set) == 0:
+    if len(digests) == 0:
         result = 'no_comparison'
-    elif len(digest_set) == 1:
+    # Comparing against the first digest directly avoids hashing every digest into a set per test value.
+    elif all(digest == digests[0] for digest in digests):
         result = 'consistent'
-        digest_comparison['digest'] = digest_set.pop()
+        digest_comparison['digest'] = digests[0].decode()
     else:
+        # Only the rare inconsistent case needs the per-implementation breakdown.
         result = 'inconsistent'
-        impl_digests = {}
-        for impl_name, digest in digests.items():
-            impl_digests[impl_name] = digest
+        digest_comparison['digests'] = dict(zip(hash_lines.keys(), (digest.decode() for digest in digests)))
 
-        digest_comparison['digests'] = impl_digests
-
-    digest_comparison['result'] = SymbolToken(result, None, None)
+    digest_comparison['result'] = _RESULT_TOKENS[result]
     digest_comparison['value'] = simpleion.dumps(value, binary=False, omit_version_marker=True)
     digest_comparisons.append(digest_comparison)
 
-    return result
-
 
 def tokenize_description(description, has_name):
     """
@@ -347,6 +438,38 @@ def tokenize_description(description, has_name):
         return components[max_components - 2], revision
 
 
+def test_generation_key(ion_hash_test_dir, test_file_filter):
+    """
+    Returns a digest identifying the inputs to test generation: the ion-hash-test revision, the requested test
+    file subset, and the generator's own source. When none of these have changed since the previous run, the
+    previously generated test files can be reused.
+    """
+    with open(test_data.__file__, 'rb') as f:
+        generator_source = f.read()
+    inputs = (git_head_commit(ion_hash_test_dir) + '|' + ','.join(sorted(test_file_filter))).encode()
+    return hashlib.sha1(inputs + b'|' + generator_source).hexdigest()
+
+
+def generate_tests_cached(ion_hash_test_dir, build_dir, test_file_filter):
+    """
+    Calls `generate_tests`, reusing the previous run's output when the generation inputs are unchanged.
+    The generation key and the list of generated files are stored next to the test files themselves.
+    """
+    key = test_generation_key(ion_hash_test_dir, test_file_filter)
+    key_file = os.path.join(build_dir, 'test_files.key')
+    if os.path.isfile(key_file):
+        with open(key_file) as f:
+            lines = f.read().splitlines()
+        if lines and lines[0] == key and all(os.path.isfile(test_file) for test_file in lines[1:]):
+            print("Test files are up to date; skipping generation.")
+            return lines[1:]
+    test_files = generate_tests(ion_hash_test_dir, build_dir, test_file_filter)
+    with open(key_file, 'w') as f:
+        f.write(key + '\n')
+        f.writelines(test_file + '\n' for test_file in test_files)
+    return test_files
+
+
 def parse_implementations(descriptions, output_root):
     return [IonHashImplementation(output_root, *tokenize_description(description, has_name=True))
             for description in descriptions]
@@ -367,24 +490,29 @@ def ion_hash_test_driver(arguments):
         implementations = parse_implementations(ION_IMPLEMENTATIONS, output_root)
 
         check_tool_dependencies(arguments)
-        for implementation in implementations:
-            implementation.install()
+        # Installation is dominated by cloning and building through subprocesses, so installing the implementations
+        # concurrently reduces this phase's wall clock time to that of the slowest installation.
+        with ThreadPoolExecutor(max_workers=min(8, len(implementations))) as executor:
+            list(executor.map(lambda implementation: implementation.install(), implementations))
 
         ion_hash_test_source = ION_HASH_TEST_SOURCE
         ion_hash_test_dir = IonResource(
             output_root, 'ion-hash-test', *tokenize_description(ion_hash_test_source, has_name=False)
         ).install()
 
-        test_files = generate_tests(ion_hash_test_dir, os.path.join(output_root, "build"), arguments['<test_file>'])
+        test_files = generate_tests_cached(ion_hash_test_dir, os.path.join(output_root, "build"),
+                                           arguments['<test_file>'])
         if len(test_files) == 0:
             print("No files to test, exiting")
             sys.exit(1)
 
-        for impl in implementations:
-            impl.execute(test_files, "md5")
+        # The implementations are independent executables that each write to their own output files, so they may
+        # all run concurrently; the wall clock time for this phase is bounded by the slowest implementation.
+        with ThreadPoolExecutor(max_workers=len(implementations)) as executor:
+            list(executor.map(lambda impl: impl.execute(test_files, "md5"), implementations))
 
         results_file = os.path.join(output_root, "build", arguments['--results-file'] or RESULTS_FILE_DEFAULT)
-        generate_results(implementations, test_files, results_file)
+        generate_results(implementations, test_files, results_file, binary=not arguments['--text-results'])
 
 
 if __name__ == '__main__':
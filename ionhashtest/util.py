@@ -25,13 +25,17 @@ if sys.platform.startswith('win'):
     COMMAND_SHELL = True  # shell=True on Windows allows the .exe suffix to be omitted.
 
 
-def log_call(log, args):
+def log_call(log, args, cwd=None):
     """
     Logs the stdout and stderr for the given subprocess call to the given file.
+    :param log: path to the log file.
+    :param args: the command to run.
+    :param cwd: if not None, the working directory for the command. This is passed to the subprocess rather than
+        changing this process's working directory, which would race against concurrent installations.
     """
     log_file = open(log, 'a' if os.path.isfile(log) else 'w')
     try:
-        check_call(args, shell=COMMAND_SHELL, stdout=log_file, stderr=log_file)
+        check_call(args, shell=COMMAND_SHELL, stdout=log_file, stderr=log_file, cwd=cwd)
     finally:
         log_file.close()
 
@@ -40,14 +44,15 @@ class IonBuild:
     def __init__(self, installer, executable):
         """
         Build information for an Ion resource.
-        :param installer: function which builds the resource.
+        :param installer: function which builds the resource, given a log file path and the directory containing the
+            resource's source.
         :param executable: path to the resource's executable (if any), relative to the root of the implementation.
         """
         self.install = installer
         self.execute = executable
 
 
-def install_no_op(log):
+def install_no_op(log, cwd):
     pass
 
 
@@ -30,9 +30,5 @@ setup(
     license='Apache License 2.0',
 
     packages=find_packages(exclude=['tests*']),
-
-    requires=[
-        'six',
-    ],
 )
 